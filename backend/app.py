@@ -3,19 +3,33 @@ FastAPI Backend for Car Video Generation
 Wraps the existing gg.py pipeline with REST API endpoints
 """
 
-from fastapi import FastAPI, UploadFile, File, BackgroundTasks, HTTPException, Request
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, Response
 from pydantic import BaseModel
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Receive, Scope, Send
 from typing import List, Optional
 import os
 import sys
 import uuid
 import shutil
+import time
 from pathlib import Path
 import asyncio
+import hashlib
+import json
 import logging
-from datetime import datetime
+from contextlib import asynccontextmanager
+from datetime import date
+
+import aiofiles
+import aiofiles.os
+import redis.asyncio as aioredis
+from arq import create_pool
+from arq.connections import RedisSettings
+from arq.constants import abort_jobs_ss
+from arq.jobs import Job
 
 # Add parent directory to path to import gg.py
 sys.path.append(str(Path(__file__).parent.parent))
@@ -25,7 +39,57 @@ from gg import process_car_images
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Car Video Generator API")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open the arq job queue pool for the lifetime of the app"""
+    app.state.arq_pool = await create_pool(RedisSettings.from_dsn(REDIS_URL))
+    yield
+    await app.state.arq_pool.close()
+
+app = FastAPI(
+    title="Car Video Generator API",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+
+# Upload size limits
+MAX_TOTAL_UPLOAD_BYTES = int(os.getenv("MAX_TOTAL_UPLOAD_BYTES", str(200 * 1024 * 1024)))
+MAX_PER_FILE_BYTES = int(os.getenv("MAX_PER_FILE_BYTES", str(25 * 1024 * 1024)))
+
+class UploadSizeLimitMiddleware:
+    """
+    Reject oversized uploads from Content-Length before the body is read.
+    Plain ASGI, so every route other than /api/upload passes straight through.
+    """
+    
+    def __init__(self, app: ASGIApp):
+        self.app = app
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"] != "/api/upload":
+            await self.app(scope, receive, send)
+            return
+        
+        response = None
+        try:
+            content_length = int(Headers(scope=scope).get("content-length", "0"))
+        except ValueError:
+            response = JSONResponse(status_code=400, content={"detail": "Invalid Content-Length header"})
+        else:
+            if content_length > MAX_TOTAL_UPLOAD_BYTES:
+                response = JSONResponse(
+                    status_code=413,
+                    content={"detail": f"Upload too large. Maximum total size is {MAX_TOTAL_UPLOAD_BYTES // (1024 * 1024)} MB."},
+                )
+        
+        if response is not None:
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+app.add_middleware(UploadSizeLimitMiddleware)
 
 # CORS middleware
 app.add_middleware(
@@ -42,12 +106,64 @@ OUTPUT_DIR = Path("./outputs")
 UPLOAD_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
 
-# Store job status in memory (use Redis in production)
-job_status = {}
+# Per-request paths are built from plain strings with os.path.join
+UPLOAD_DIR_STR = str(UPLOAD_DIR)
+OUTPUT_DIR_STR = str(OUTPUT_DIR)
+
+# When running behind nginx, let it serve output files directly.
+# nginx needs a matching internal location, e.g.
+#   location /_internal/outputs/ { internal; alias /app/outputs/; }
+USE_XACCEL = bool(os.getenv("USE_XACCEL"))
+XACCEL_PREFIX = "/_internal/outputs/"
+
+# Uploads are streamed to disk in chunks of this size
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+
+# Shared state store: job status and rate limits live in Redis so that every
+# uvicorn worker sees the same data and stale entries expire on their own.
+# Jobs:        hash  job:{job_id}      -> status, progress, input_files, result, error
+# Rate limits: int   rl:{ip}:{day}     -> generations used that day
+redis = aioredis.from_url(REDIS_URL, decode_responses=True)
+
+# Job records expire one day after their last update, rate-limit counters one day after creation
+JOB_TTL_SECONDS = 86400
+RATE_LIMIT_TTL_SECONDS = 86400
+
+def job_key(job_id: str) -> str:
+    """Redis key holding the status hash for a job."""
+    return f"job:{job_id}"
+
+def rate_limit_key(ip_address: str, day: int) -> str:
+    """Redis key holding the generation counter for an IP on a given day."""
+    return f"rl:{ip_address}:{day}"
+
+def decode_job(data: dict) -> dict:
+    """Decode JSON-encoded fields of a job hash read from Redis."""
+    job = dict(data)
+    for field in ("input_files", "result"):
+        if job.get(field):
+            job[field] = json.loads(job[field])
+    return job
+
+async def _update_job(job_id: str, **fields):
+    """
+    Write a state transition as a single HSET.
+    The expiry restarts on every write, so finished jobs are kept for
+    JOB_TTL_SECONDS after their last update and a record recreated by a late
+    write (e.g. after deletion) can't linger forever.
+    """
+    key = job_key(job_id)
+    pipe = redis.pipeline()
+    pipe.hset(key, mapping=fields)
+    pipe.expire(key, JOB_TTL_SECONDS)
+    await pipe.execute()
 
-# Rate limiting: Track generations per IP per day
-# Format: { "ip_address": { "date": "YYYY-MM-DD", "count": N } }
-rate_limit_store = {}
+async def _get_job_or_404(job_id: str) -> dict:
+    """Fetch and decode a job in one round-trip, or raise 404 if it doesn't exist."""
+    data = await redis.hgetall(job_key(job_id))
+    if not data:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return decode_job(data)
 
 class JobResponse(BaseModel):
     job_id: str
@@ -61,39 +177,50 @@ class JobStatusResponse(BaseModel):
     result: Optional[dict] = None
     error: Optional[str] = None
 
+class JobDetailsResponse(JobStatusResponse):
+    video_url: Optional[str] = None
+    contact_sheet_url: Optional[str] = None
+
 # Rate limiting configuration
 MAX_GENERATIONS_PER_DAY = 15
 
-def check_rate_limit(ip_address: str) -> tuple[bool, int]:
+# How long a cancel request waits for the worker to confirm the abort
+JOB_ABORT_TIMEOUT_SECONDS = 5
+
+# Days are counted as whole days since the Unix epoch (UTC)
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def _today_ordinal() -> int:
+    """Current day as days since the Unix epoch. Cheaper than formatting a date."""
+    return int(time.time()) // 86400
+
+def format_day(day: int) -> str:
+    """Format a day ordinal from _today_ordinal as YYYY-MM-DD."""
+    return date.fromordinal(EPOCH_ORDINAL + day).isoformat()
+
+async def get_rate_limit_count(ip_address: str, day: int) -> int:
+    """Get the number of generations used on a given day by an IP address."""
+    count = await redis.get(rate_limit_key(ip_address, day))
+    return int(count) if count else 0
+
+async def bump_and_check(ip_address: str) -> int:
     """
-    Check if IP address has exceeded daily rate limit.
-    Returns (is_allowed, remaining_count)
+    Atomically count a generation for an IP address.
+    Returns the new count for today; callers compare it against the limit.
     """
-    today = datetime.now().strftime("%Y-%m-%d")
-    
-    if ip_address not in rate_limit_store:
-        rate_limit_store[ip_address] = {"date": today, "count": 0}
-    
-    user_data = rate_limit_store[ip_address]
+    # Keys are per-day, so a new day starts from a fresh counter
+    key = rate_limit_key(ip_address, _today_ordinal())
     
-    # Reset count if it's a new day
-    if user_data["date"] != today:
-        rate_limit_store[ip_address] = {"date": today, "count": 0}
-        user_data = rate_limit_store[ip_address]
-    
-    remaining = MAX_GENERATIONS_PER_DAY - user_data["count"]
-    is_allowed = user_data["count"] < MAX_GENERATIONS_PER_DAY
-    
-    return is_allowed, max(0, remaining)
+    # One round-trip: INCR is atomic across workers, expiry is only set on a new key
+    pipe = redis.pipeline()
+    pipe.incr(key)
+    pipe.expire(key, RATE_LIMIT_TTL_SECONDS, nx=True)
+    count, _ = await pipe.execute()
+    return count
 
-def increment_rate_limit(ip_address: str):
-    """Increment the generation count for an IP address."""
-    today = datetime.now().strftime("%Y-%m-%d")
-    
-    if ip_address not in rate_limit_store:
-        rate_limit_store[ip_address] = {"date": today, "count": 0}
-    
-    rate_limit_store[ip_address]["count"] += 1
+async def refund_rate_limit(ip_address: str):
+    """Give back a generation that was counted but not used."""
+    await redis.decr(rate_limit_key(ip_address, _today_ordinal()))
 
 @app.get("/")
 async def root():
@@ -104,23 +231,42 @@ async def root():
 async def get_rate_limit(request: Request):
     """Get remaining generations for the current user"""
     client_ip = request.client.host if request.client else "unknown"
-    is_allowed, remaining = check_rate_limit(client_ip)
-    
-    today = datetime.now().strftime("%Y-%m-%d")
-    used = rate_limit_store.get(client_ip, {}).get("count", 0) if client_ip in rate_limit_store else 0
+    today = _today_ordinal()
+    used = await get_rate_limit_count(client_ip, today)
+    remaining = max(0, MAX_GENERATIONS_PER_DAY - used)
+    is_allowed = used < MAX_GENERATIONS_PER_DAY
     
     return {
         "max_per_day": MAX_GENERATIONS_PER_DAY,
         "used_today": used,
         "remaining_today": remaining,
-        "date": today,
+        "date": format_day(today),
         "is_allowed": is_allowed
     }
 
+async def _save_one(file: UploadFile, file_path: str) -> str:
+    """Stream one uploaded file to disk and return its path."""
+    bytes_written = 0
+    async with aiofiles.open(file_path, "wb") as buffer:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            bytes_written += len(chunk)
+            if bytes_written > MAX_PER_FILE_BYTES:
+                break
+            await buffer.write(chunk)
+    
+    if bytes_written > MAX_PER_FILE_BYTES:
+        await aiofiles.os.remove(file_path)
+        raise HTTPException(
+            status_code=413,
+            detail=f"File {file.filename} is too large. Maximum size is {MAX_PER_FILE_BYTES // (1024 * 1024)} MB per file."
+        )
+    
+    logger.info(f"Saved file: {os.path.basename(file_path)}")
+    return file_path
+
 @app.post("/api/upload", response_model=JobResponse)
 async def upload_images(
     request: Request,
-    background_tasks: BackgroundTasks,
     files: List[UploadFile] = File(...)
 ):
     """
@@ -132,68 +278,82 @@ async def upload_images(
     # Get client IP address
     client_ip = request.client.host if request.client else "unknown"
     
-    # Check rate limit
-    is_allowed, remaining = check_rate_limit(client_ip)
+    # Count this generation and check the rate limit in one step
+    count = await bump_and_check(client_ip)
     
-    if not is_allowed:
+    if count > MAX_GENERATIONS_PER_DAY:
+        await refund_rate_limit(client_ip)
         logger.warning(f"Rate limit exceeded for IP: {client_ip}")
         raise HTTPException(
             status_code=429,
             detail=f"Daily generation limit reached. You have used all {MAX_GENERATIONS_PER_DAY} generations today. Please try again tomorrow."
         )
     
+    remaining = MAX_GENERATIONS_PER_DAY - count
     logger.info(f"Rate limit check for {client_ip}: {remaining} generations remaining")
     
     # Generate unique job ID
-    job_id = str(uuid.uuid4())
+    job_id = uuid.uuid4().hex
     
     # Create job directory
-    job_input_dir = UPLOAD_DIR / job_id
-    job_output_dir = OUTPUT_DIR / job_id
-    job_input_dir.mkdir(parents=True, exist_ok=True)
-    job_output_dir.mkdir(parents=True, exist_ok=True)
+    job_input_dir = os.path.join(UPLOAD_DIR_STR, job_id)
+    job_output_dir = os.path.join(OUTPUT_DIR_STR, job_id)
+    os.makedirs(job_input_dir, exist_ok=True)
+    os.makedirs(job_output_dir, exist_ok=True)
     
     # Save uploaded files
     try:
         logger.info(f"Received {len(files)} file(s) for upload")
-        saved_files = []
+        
+        # Allocate unique paths up front so the files can be saved concurrently
+        file_paths = []
+        used_names = set()
         for idx, file in enumerate(files, 1):
             # Preserve original filename or add index if duplicate
-            file_path = job_input_dir / file.filename
-            if file_path.exists():
-                # Handle duplicate filenames
-                stem = file_path.stem
-                suffix = file_path.suffix
-                file_path = job_input_dir / f"{stem}_{idx}{suffix}"
-                logger.warning(f"Duplicate filename detected, saving as: {file_path.name}")
-            
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            saved_files.append(str(file_path))
-            logger.info(f"Saved file {idx}/{len(files)}: {file_path.name}")
+            file_name = os.path.basename(file.filename)
+            if file_name in used_names:
+                # Handle duplicate filenames; the renamed file may itself collide
+                # (e.g. a.jpg, a_3.jpg, a.jpg), so keep going until it's unique
+                stem, suffix = os.path.splitext(file_name)
+                n = idx
+                while f"{stem}_{n}{suffix}" in used_names:
+                    n += 1
+                file_name = f"{stem}_{n}{suffix}"
+                logger.warning(f"Duplicate filename detected, saving as: {file_name}")
+            used_names.add(file_name)
+            file_paths.append(os.path.join(job_input_dir, file_name))
+        
+        save_tasks = [
+            asyncio.create_task(_save_one(file, file_path))
+            for file, file_path in zip(files, file_paths)
+        ]
+        try:
+            saved_files = await asyncio.gather(*save_tasks)
+        except BaseException:
+            # One file failed: stop the others before their directory is removed
+            for task in save_tasks:
+                task.cancel()
+            await asyncio.gather(*save_tasks, return_exceptions=True)
+            raise
         
         logger.info(f"Successfully saved {len(saved_files)} file(s) to {job_input_dir}")
         
         # Initialize job status
-        job_status[job_id] = {
-            "status": "queued",
-            "progress": "Starting video generation...",
-            "input_files": saved_files,
-        }
-        
-        # Increment rate limit counter
-        increment_rate_limit(client_ip)
-        
-        # Start background task
-        background_tasks.add_task(
-            process_video_generation,
+        await _update_job(
             job_id,
-            str(job_input_dir),
-            str(job_output_dir)
+            status="queued",
+            progress="Starting video generation...",
+            input_files=json.dumps(saved_files),
         )
         
-        # Get remaining generations
-        _, remaining = check_rate_limit(client_ip)
+        # Hand the job to the arq worker (see worker.py)
+        await request.app.state.arq_pool.enqueue_job(
+            "run_job",
+            job_id,
+            job_input_dir,
+            job_output_dir,
+            _job_id=job_id,
+        )
         
         return JobResponse(
             job_id=job_id,
@@ -201,24 +361,36 @@ async def upload_images(
             message=f"Processing {len(files)} images. {remaining} generations remaining today. Check status at /api/status/{job_id}"
         )
         
+    except HTTPException:
+        # Don't leave partial uploads behind; no job record points at them
+        await delete_job_files(job_id)
+        await refund_rate_limit(client_ip)
+        raise
     except Exception as e:
         logger.error(f"Error uploading files: {e}")
+        await delete_job_files(job_id)
+        # The generation never started, so don't count it against the quota
+        await refund_rate_limit(client_ip)
         raise HTTPException(status_code=500, detail=str(e))
 
+async def _job_stopped(job_id: str) -> bool:
+    """True once a job is cancelled or deleted; the pipeline must not write its status back"""
+    return await redis.hget(job_key(job_id), "status") in (None, "cancelled")
+
 async def process_video_generation(job_id: str, input_dir: str, output_dir: str):
     """
-    Background task to process video generation
+    Process video generation for a job. Runs in the arq worker process.
     """
     try:
         logger.info(f"Starting job {job_id}")
         
         # Check if job was cancelled before starting
-        if job_status[job_id].get("status") == "cancelled":
+        if await _job_stopped(job_id):
             logger.info(f"Job {job_id} was cancelled before processing started")
             return
         
-        job_status[job_id]["status"] = "processing"
-        job_status[job_id]["progress"] = "Generating contact sheet..."
+        # Concurrency is capped by the worker's max_jobs (MAX_CONCURRENT_JOBS)
+        await _update_job(job_id, status="processing", progress="Generating contact sheet...")
         
         # Run the pipeline
         result = await process_car_images(
@@ -227,40 +399,69 @@ async def process_video_generation(job_id: str, input_dir: str, output_dir: str)
         )
         
         # Check if cancelled during processing
-        if job_status[job_id].get("status") == "cancelled":
+        if await _job_stopped(job_id):
             logger.info(f"Job {job_id} was cancelled during processing")
             return
         
         if "error" in result:
-            job_status[job_id]["status"] = "failed"
-            job_status[job_id]["error"] = result["error"]
+            await _update_job(job_id, status="failed", error=result["error"])
             logger.error(f"Job {job_id} failed: {result['error']}")
         else:
-            job_status[job_id]["status"] = "completed"
-            job_status[job_id]["result"] = {
+            outputs = {
                 "contact_sheet": result.get("contact_sheet_path"),
                 "final_video": result.get("final_video_path"),
-                "summary": result.get("summary"),
             }
-            job_status[job_id]["progress"] = "Video generation complete!"
+            await _update_job(
+                job_id,
+                status="completed",
+                progress="Video generation complete!",
+                result=json.dumps({
+                    **outputs,
+                    "summary": result.get("summary"),
+                    "files": await stat_outputs(outputs),
+                }),
+            )
             logger.info(f"Job {job_id} completed successfully")
             
+    except asyncio.CancelledError:
+        # Cancel/delete have already marked (or removed) the job; anything else
+        # cancelling us is arq's job_timeout, so don't leave it "processing"
+        if await _job_stopped(job_id):
+            logger.info(f"Job {job_id} was aborted during processing")
+        else:
+            logger.warning(f"Job {job_id} timed out")
+            await _update_job(job_id, status="failed", error="Job timed out")
+        raise
     except Exception as e:
         # Don't mark as failed if it was cancelled
-        if job_status[job_id].get("status") != "cancelled":
+        if not await _job_stopped(job_id):
             logger.exception(f"Error processing job {job_id}")
-            job_status[job_id]["status"] = "failed"
-            job_status[job_id]["error"] = str(e)
+            await _update_job(job_id, status="failed", error=str(e))
+
+def job_etag(job: dict) -> str:
+    """ETag for a job's visible state. It only changes on state transitions."""
+    digest = hashlib.blake2b(f"{job['status']}|{job.get('progress')}".encode(), digest_size=8).hexdigest()
+    return f'"{digest}"'
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """Return a 304 response if the client already has this ETag."""
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return None
 
 @app.get("/api/status/{job_id}", response_model=JobStatusResponse)
-async def get_job_status(job_id: str):
+async def get_job_status(request: Request, response: Response, job_id: str):
     """
     Get the status of a video generation job
     """
-    if job_id not in job_status:
-        raise HTTPException(status_code=404, detail="Job not found")
+    job = await _get_job_or_404(job_id)
+    
+    # Pollers mostly see an unchanged job, skip the body when nothing changed
+    etag = job_etag(job)
+    if cached := not_modified(request, etag):
+        return cached
+    response.headers["ETag"] = etag
     
-    job = job_status[job_id]
     return JobStatusResponse(
         job_id=job_id,
         status=job["status"],
@@ -269,24 +470,90 @@ async def get_job_status(job_id: str):
         error=job.get("error"),
     )
 
+async def stat_outputs(outputs: dict) -> dict:
+    """
+    Record size and mtime of each existing output file, keyed like `outputs`.
+    Downloads trust this record instead of stat-ing the file again.
+    """
+    files = {}
+    for name, path in outputs.items():
+        if not path:
+            continue
+        try:
+            stat = await aiofiles.os.stat(path)
+        except FileNotFoundError:
+            continue
+        files[name] = {"size": stat.st_size, "mtime": stat.st_mtime}
+    return files
+
+async def output_exists(job: dict, name: str) -> bool:
+    """Check whether a job's output file exists, preferring the recorded stat."""
+    result = job.get("result") or {}
+    path = result.get(name)
+    if not path:
+        return False
+    if name in result.get("files", {}):
+        return True
+    # Jobs recorded without file info (e.g. still processing) need a real check
+    return await aiofiles.os.path.exists(path)
+
+def output_file_response(path: str, media_type: str, filename: str) -> Response:
+    """
+    Serve a file from OUTPUT_DIR.
+    Behind nginx the body is left empty and nginx sends the file itself.
+    """
+    if USE_XACCEL:
+        relative_path = os.path.relpath(path, OUTPUT_DIR_STR)
+        return Response(
+            media_type=media_type,
+            headers={
+                "X-Accel-Redirect": f"{XACCEL_PREFIX}{relative_path}",
+                "Content-Disposition": f'attachment; filename="{filename}"',
+            },
+        )
+    
+    return FileResponse(path, media_type=media_type, filename=filename)
+
+@app.get("/api/jobs/{job_id}", response_model=JobDetailsResponse)
+async def get_job(request: Request, response: Response, job_id: str):
+    """
+    Get job status plus download URLs for any outputs that are ready,
+    so clients only need to poll this one endpoint
+    """
+    job = await _get_job_or_404(job_id)
+    
+    etag = job_etag(job)
+    if cached := not_modified(request, etag):
+        return cached
+    response.headers["ETag"] = etag
+    
+    result = job.get("result") or {}
+    files = result.get("files", {})
+    
+    return JobDetailsResponse(
+        job_id=job_id,
+        status=job["status"],
+        progress=job.get("progress"),
+        result=job.get("result"),
+        error=job.get("error"),
+        video_url=f"/api/download/{job_id}/video" if job["status"] == "completed" and "final_video" in files else None,
+        contact_sheet_url=f"/api/download/{job_id}/contact-sheet" if "contact_sheet" in files else None,
+    )
+
 @app.get("/api/download/{job_id}/video")
 async def download_video(job_id: str):
     """
     Download the final generated video
     """
-    if job_id not in job_status:
-        raise HTTPException(status_code=404, detail="Job not found")
-    
-    job = job_status[job_id]
+    job = await _get_job_or_404(job_id)
     if job["status"] != "completed":
         raise HTTPException(status_code=400, detail="Video not ready yet")
     
-    video_path = job["result"]["final_video"]
-    if not video_path or not Path(video_path).exists():
+    if not await output_exists(job, "final_video"):
         raise HTTPException(status_code=404, detail="Video file not found")
     
-    return FileResponse(
-        video_path,
+    return output_file_response(
+        job["result"]["final_video"],
         media_type="video/mp4",
         filename=f"car_showcase_{job_id}.mp4"
     )
@@ -296,32 +563,40 @@ async def download_contact_sheet(job_id: str):
     """
     Download the contact sheet image
     """
-    if job_id not in job_status:
-        raise HTTPException(status_code=404, detail="Job not found")
-    
-    job = job_status[job_id]
+    job = await _get_job_or_404(job_id)
     if job["status"] not in ["processing", "completed"]:
         raise HTTPException(status_code=400, detail="Contact sheet not ready yet")
     
-    contact_sheet_path = job["result"]["contact_sheet"]
-    if not contact_sheet_path or not Path(contact_sheet_path).exists():
+    if not await output_exists(job, "contact_sheet"):
         raise HTTPException(status_code=404, detail="Contact sheet not found")
     
-    return FileResponse(
-        contact_sheet_path,
+    return output_file_response(
+        job["result"]["contact_sheet"],
         media_type="image/png",
         filename=f"contact_sheet_{job_id}.png"
     )
 
+async def _abort_job(request: Request, job_id: str, status: str):
+    """Mark a job cancelled and abort its worker task so the pipeline stops at its next await"""
+    await _update_job(job_id, status="cancelled", progress="Job cancelled by user")
+    
+    if status != "processing":
+        # arq only settles an abort for a queued job once a worker slot dequeues it,
+        # so just record it; _job_stopped makes the job exit as soon as it starts
+        await request.app.state.arq_pool.zadd(abort_jobs_ss, {job_id: int(time.time() * 1000)})
+        return
+    
+    try:
+        await Job(job_id, request.app.state.arq_pool).abort(timeout=JOB_ABORT_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        logger.warning(f"Job {job_id} did not confirm abort within {JOB_ABORT_TIMEOUT_SECONDS}s")
+
 @app.post("/api/cancel/{job_id}")
-async def cancel_job(job_id: str):
+async def cancel_job(request: Request, job_id: str):
     """
     Cancel a running or queued job
     """
-    if job_id not in job_status:
-        raise HTTPException(status_code=404, detail="Job not found")
-    
-    job = job_status[job_id]
+    job = await _get_job_or_404(job_id)
     
     # Only allow cancellation of queued or processing jobs
     if job["status"] not in ["queued", "processing"]:
@@ -330,32 +605,39 @@ async def cancel_job(job_id: str):
             detail=f"Cannot cancel job with status: {job['status']}"
         )
     
-    # Mark as cancelled
-    job_status[job_id]["status"] = "cancelled"
-    job_status[job_id]["progress"] = "Job cancelled by user"
+    await _abort_job(request, job_id, job["status"])
     logger.info(f"Job {job_id} cancelled by user")
     
     return {"message": "Job cancelled successfully", "job_id": job_id}
 
+async def delete_job_files(job_id: str):
+    """
+    Delete a job's files and status record
+    """
+    job_input_dir = os.path.join(UPLOAD_DIR_STR, job_id)
+    job_output_dir = os.path.join(OUTPUT_DIR_STR, job_id)
+    
+    # Walking large output trees can take a while, keep it off the event loop
+    await asyncio.to_thread(shutil.rmtree, job_input_dir, ignore_errors=True)
+    await asyncio.to_thread(shutil.rmtree, job_output_dir, ignore_errors=True)
+    
+    # Remove from status
+    await redis.delete(job_key(job_id))
+    logger.info(f"Job {job_id} deleted")
+
 @app.delete("/api/jobs/{job_id}")
-async def delete_job(job_id: str):
+async def delete_job(request: Request, job_id: str):
     """
     Delete a job and its associated files
     """
-    if job_id not in job_status:
-        raise HTTPException(status_code=404, detail="Job not found")
-    
-    # Delete files
-    job_input_dir = UPLOAD_DIR / job_id
-    job_output_dir = OUTPUT_DIR / job_id
+    job = await _get_job_or_404(job_id)
     
-    if job_input_dir.exists():
-        shutil.rmtree(job_input_dir)
-    if job_output_dir.exists():
-        shutil.rmtree(job_output_dir)
+    # Stop a running pipeline first so it doesn't keep spending quota or
+    # writing into the directories we're about to remove
+    if job["status"] in ["queued", "processing"]:
+        await _abort_job(request, job_id, job["status"])
     
-    # Remove from status
-    del job_status[job_id]
+    await delete_job_files(job_id)
     
     return {"message": "Job deleted successfully"}
 
@@ -0,0 +1,11 @@
+#!/usr/bin/env bash
+# Start the API and the arq worker in one container so they share uploads/ and outputs/
+set -euo pipefail
+
+arq worker.WorkerSettings &
+python app.py &
+
+# Forward shutdown to both; exit as soon as either one stops so the platform restarts us
+trap 'kill $(jobs -p) 2>/dev/null' TERM INT
+wait -n
+exit $?
@@ -0,0 +1,35 @@
+"""
+arq worker for Car Video Generation
+Runs the gg.py pipeline out of the API process so jobs survive API restarts
+
+Start with: arq worker.WorkerSettings
+"""
+
+import os
+
+from arq.connections import RedisSettings
+
+from app import REDIS_URL, process_video_generation
+from gg import close_http_session, install_fast_event_loop
+
+# Must be set before arq creates the worker's event loop
+install_fast_event_loop()
+
+async def run_job(ctx, job_id: str, input_dir: str, output_dir: str):
+    """Run the video generation pipeline for a queued job"""
+    await process_video_generation(job_id, input_dir, output_dir)
+
+async def shutdown(ctx):
+    """Close pipeline HTTP connections when the worker stops"""
+    await close_http_session()
+
+class WorkerSettings:
+    functions = [run_job]
+    on_shutdown = shutdown
+    redis_settings = RedisSettings.from_dsn(REDIS_URL)
+    # Pipelines running at once in this worker
+    max_jobs = int(os.getenv("MAX_CONCURRENT_JOBS", "2"))
+    # A full pipeline (contact sheet, upscales, 8 videos) takes many minutes
+    job_timeout = int(os.getenv("JOB_TIMEOUT_SECONDS", "3600"))
+    # Lets /api/cancel abort a running pipeline by cancelling its task
+    allow_abort_jobs = True
@@ -0,0 +1,39 @@
+import { NextRequest, NextResponse } from 'next/server';
+
+const BACKEND_URL = process.env.BACKEND_API_URL || 'http://localhost:8000';
+
+export async function GET(
+  request: NextRequest,
+  { params }: { params: Promise<{ jobId: string }> }
+) {
+  try {
+    const { jobId } = await params;
+    
+    // Forward the client's ETag so unchanged jobs come back as 304
+    const ifNoneMatch = request.headers.get('if-none-match');
+    const response = await fetch(`${BACKEND_URL}/api/jobs/${jobId}`, {
+      method: 'GET',
+      headers: ifNoneMatch ? { 'If-None-Match': ifNoneMatch } : {},
+    });
+
+    const etag = response.headers.get('etag');
+    if (response.status === 304) {
+      return new NextResponse(null, {
+        status: 304,
+        headers: etag ? { ETag: etag } : {},
+      });
+    }
+
+    const data = await response.json();
+    return NextResponse.json(data, {
+      status: response.status,
+      headers: etag ? { ETag: etag } : {},
+    });
+  } catch (error) {
+    console.error('Job proxy error:', error);
+    return NextResponse.json(
+      { error: 'Failed to fetch job' },
+      { status: 500 }
+    );
+  }
+}
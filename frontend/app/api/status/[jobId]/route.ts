@@ -9,12 +9,26 @@ export async function GET(
   try {
     const { jobId } = await params;
     
+    // Forward the client's ETag so unchanged jobs come back as 304
+    const ifNoneMatch = request.headers.get('if-none-match');
     const response = await fetch(`${BACKEND_URL}/api/status/${jobId}`, {
       method: 'GET',
+      headers: ifNoneMatch ? { 'If-None-Match': ifNoneMatch } : {},
     });
 
+    const etag = response.headers.get('etag');
+    if (response.status === 304) {
+      return new NextResponse(null, {
+        status: 304,
+        headers: etag ? { ETag: etag } : {},
+      });
+    }
+
     const data = await response.json();
-    return NextResponse.json(data, { status: response.status });
+    return NextResponse.json(data, {
+      status: response.status,
+      headers: etag ? { ETag: etag } : {},
+    });
   } catch (error) {
     console.error('Status proxy error:', error);
     return NextResponse.json(
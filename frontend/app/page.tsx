@@ -19,6 +19,8 @@ interface JobStatus {
     };
   };
   error?: string;
+  video_url?: string;
+  contact_sheet_url?: string;
 }
 
 export default function Home() {
@@ -101,7 +103,7 @@ export default function Home() {
 
     const interval = setInterval(async () => {
       try {
-        const response = await axios.get(`/api/status/${id}`);
+        const response = await axios.get(`/api/jobs/${id}`);
         setJobStatus(response.data);
 
         if (response.data.status === 'completed' || response.data.status === 'failed' || response.data.status === 'cancelled') {
@@ -150,14 +152,14 @@ export default function Home() {
   };
 
   const downloadVideo = () => {
-    if (jobId) {
-      window.open(`/api/download/${jobId}/video`, '_blank');
+    if (jobStatus?.video_url) {
+      window.open(jobStatus.video_url, '_blank');
     }
   };
 
   const downloadContactSheet = () => {
-    if (jobId) {
-      window.open(`/api/download/${jobId}/contact-sheet`, '_blank');
+    if (jobStatus?.contact_sheet_url) {
+      window.open(jobStatus.contact_sheet_url, '_blank');
     }
   };
 
@@ -359,7 +361,7 @@ export default function Home() {
                   <video
                     controls
                     className="w-full h-full"
-                    src={`/api/download/${jobId}/video`}
+                    src={jobStatus.video_url}
                   >
                     Your browser does not support the video tag.
                   </video>
@@ -5,24 +5,42 @@ Generates professional automotive showcase videos from car images.
 All files stored locally - no cloud storage required.
 
 Requirements:
-pip install aiohttp requests pillow google-genai python-dotenv
+pip install aiohttp aiofiles numpy pillow google-genai python-dotenv
 """
 
 import asyncio
+import contextlib
+import functools
+import hashlib
+import mimetypes
 import time
 import os
+import random
+import re
+import shutil
 import sys
 from pathlib import Path
 from io import BytesIO
-from typing import Any, Dict, Optional, List
-from uuid import uuid4
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, Final, Optional, List
+from uuid import UUID, uuid4
 from enum import Enum
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from types import MappingProxyType
 
+import aiofiles
 import aiohttp
-import requests
+import numpy as np
 from PIL import Image
 from dotenv import load_dotenv
 
+# Optional: libvips for faster contact sheet cropping, PIL is used without it
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -42,27 +60,63 @@ GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY", "").strip()
 # ImgBB Configuration (for temporary image hosting)
 IMGBB_API_KEY = os.getenv("IMGBB_API_KEY", "").strip()
 
-# Validate Higgsfield API key format (should be UUID)
-if HIGGSFIELD_API_KEY:
-    import re
-    uuid_pattern = r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$'
-    if not re.match(uuid_pattern, HIGGSFIELD_API_KEY, re.IGNORECASE):
-        logger.warning(f"HIGGSFIELD_API_KEY format looks incorrect. Expected UUID format, got: {HIGGSFIELD_API_KEY}")
-        logger.warning("Make sure your .env file has clean values without extra text")
+# Cache directory for populated Stage 1 prompts, least recently used pruned past the cap
+CACHE_DIR = Path(os.getenv("CACHE_DIR", "./cache"))
+PROMPT_CACHE_MAX_ENTRIES = int(os.getenv("PROMPT_CACHE_MAX_ENTRIES", "256"))
+
+# Gemini quota: requests and tokens per minute (keep ~10% below your tier's limits)
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "90"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "27000"))
+
+# Frame upscaler: "gemini" (model re-render) or "vips" (local Lanczos, needs pyvips)
+UPSCALE_BACKEND = os.getenv("UPSCALE_BACKEND", "gemini").strip().lower()
+
+# Outer deadline for a single generate_content call (seconds)
+GEMINI_CALL_TIMEOUT_S = float(os.getenv("GEMINI_CALL_TIMEOUT_S", "120"))
 
 
 # ============================================================================
 # LOGGING
 # ============================================================================
 
+import atexit
 import logging
+import logging.handlers
+import queue
+
+_LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
+    format=_LOG_FORMAT
 )
 logger = logging.getLogger(__name__)
 
+# Pipeline tasks only enqueue log records; a background thread does the
+# (possibly slow) terminal/file writes so they never block the event loop
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter(_LOG_FORMAT))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+logger.propagate = False
+
+def _init_worker_logging():
+    """Log directly in pool worker processes; the queue listener thread only runs in the parent"""
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(_log_handler)
+
+# Validate Higgsfield API key format (should be UUID)
+if HIGGSFIELD_API_KEY:
+    try:
+        UUID(HIGGSFIELD_API_KEY)
+    except ValueError:
+        logger.warning(f"HIGGSFIELD_API_KEY format looks incorrect. Expected UUID format, got: {HIGGSFIELD_API_KEY}")
+        logger.warning("Make sure your .env file has clean values without extra text")
+
 # ============================================================================
 # GOOGLE GEMINI IMAGE GENERATION
 # ============================================================================
@@ -71,11 +125,70 @@ from google import genai
 from google.genai import types
 
 # Initialize Google GenAI client
+@functools.lru_cache(maxsize=1)
 def get_google_client():
-    """Get or create Google GenAI client"""
+    """
+    Get or create Google GenAI client.
+    One client is shared by the whole process so its HTTP connections stay warm.
+    """
     if not GOOGLE_API_KEY:
         raise ValueError("GOOGLE_API_KEY not configured in .env file")
-    return genai.Client(api_key=GOOGLE_API_KEY)
+    return genai.Client(
+        api_key=GOOGLE_API_KEY,
+        http_options=types.HttpOptions(
+            timeout=120000,  # milliseconds
+            retry_options=types.HttpRetryOptions(attempts=3),
+        ),
+    )
+
+class SlidingWindowRateLimiter:
+    """
+    Sliding-window limiter for requests (and optionally tokens) per minute.
+    Waits before a call would exceed the quota instead of reacting to 429s.
+    """
+    
+    def __init__(self, rpm: int, tpm: Optional[int] = None, window: float = 60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = window
+        self._calls: deque = deque()  # (timestamp, tokens)
+        self._tokens_in_window = 0
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self, tokens: int = 0):
+        """Wait until a call using `tokens` fits in the current window"""
+        if self.tpm is None:
+            tokens = 0
+        else:
+            # A single call larger than the whole budget would otherwise wait forever
+            tokens = min(tokens, self.tpm)
+        
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0][0] >= self.window:
+                    _, old_tokens = self._calls.popleft()
+                    self._tokens_in_window -= old_tokens
+                
+                tokens_ok = self.tpm is None or self._tokens_in_window + tokens <= self.tpm
+                if len(self._calls) < self.rpm and tokens_ok:
+                    self._calls.append((now, tokens))
+                    self._tokens_in_window += tokens
+                    return
+                
+                # Sleep until the oldest call leaves the window
+                await asyncio.sleep(self.window - (now - self._calls[0][0]))
+    
+    @contextlib.asynccontextmanager
+    async def request(self, estimated_tokens: int):
+        """Reserve quota for one generate_content call"""
+        await self.acquire(estimated_tokens)
+        yield
+
+_LIMITER = SlidingWindowRateLimiter(rpm=GEMINI_RPM, tpm=GEMINI_TPM)
+
+# Concurrent Stage 2 (image) generations
+_GEMINI_IMG_SEMA = asyncio.Semaphore(int(os.getenv("GEMINI_IMG_MAX_CONCURRENT", "4")))
 
 class OutputFormat(str, Enum):
     JPEG = "jpeg"
@@ -95,22 +208,41 @@ class AspectRatio(str, Enum):
     RATIO_5_4 = "5:4"
     RATIO_21_9 = "21:9"
 
+# Width / height for each supported aspect ratio
+_ASPECT_RATIOS: MappingProxyType = MappingProxyType({
+    "1:1": 1.0,
+    "2:3": 2/3,
+    "3:2": 3/2,
+    "16:9": 16/9,
+    "9:16": 9/16,
+    "4:3": 4/3,
+    "3:4": 3/4,
+    "4:5": 4/5,
+    "5:4": 5/4,
+    "21:9": 21/9,
+})
+
+# Image types Gemini accepts as raw bytes; anything else is sent as a PIL image
+# and re-encoded by the SDK
+_GEMINI_IMAGE_MIME_TYPES = {"image/png", "image/jpeg", "image/webp", "image/heic", "image/heif"}
+
+def _load_part(path: str):
+    """Build a Gemini content part for an image file"""
+    mime_type = mimetypes.guess_type(path)[0] or "image/jpeg"
+    if mime_type not in _GEMINI_IMAGE_MIME_TYPES:
+        return Image.open(path)
+    
+    with open(path, 'rb') as f:
+        data = f.read()
+    return types.Part.from_bytes(data=data, mime_type=mime_type)
+
+async def _load_parts(paths: List[str]) -> list:
+    """Load images as Gemini content parts off the event loop, sending the file bytes as-is"""
+    return list(await asyncio.gather(*[asyncio.to_thread(_load_part, path) for path in paths]))
+
 def crop_image_to_aspect_ratio(img: Image.Image, aspect_ratio: str) -> Image.Image:
     """Crop image to target aspect ratio"""
-    aspect_map = {
-        "1:1": 1.0,
-        "2:3": 2/3,
-        "3:2": 3/2,
-        "16:9": 16/9,
-        "9:16": 9/16,
-        "4:3": 4/3,
-        "3:4": 3/4,
-        "4:5": 4/5,
-        "5:4": 5/4,
-        "21:9": 21/9,
-    }
-    
-    target_ratio = aspect_map.get(aspect_ratio, 1.0)
+    target_ratio = _ASPECT_RATIOS.get(aspect_ratio, 1.0)
     current_ratio = img.width / img.height
     
     if abs(current_ratio - target_ratio) < 0.01:
@@ -129,25 +261,106 @@ def crop_image_to_aspect_ratio(img: Image.Image, aspect_ratio: str) -> Image.Ima
     
     return img
 
-async def populate_prompt_with_flash(image_paths: List[str], template_prompt: str) -> str:
+# Stage 1 instructions. Kept as a stable prefix so Gemini's implicit prompt
+# caching can reuse it across calls.
+_META_PROMPT_PREFIX: Final[str] = """Analyze the input image and use it to replace the bracketed example descriptors in the prompt below with accurate, image-grounded descriptions of the vehicle shown. Replace only the text inside square brackets [...]. Do not change sentence structure, ordering, or wording outside those brackets. Do not add new descriptions or remove any constraints. Do not mention tools, models, or reasoning. Return the full prompt with the bracketed descriptors replaced.
+
+Prompt to Populate:
+
+"""
+
+def _file_digest(path: str) -> bytes:
+    """BLAKE2b digest of a file's contents"""
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'blake2b').digest()
+
+# Any bracketed upper-case placeholder, e.g. [VEHICLE_MAKE_MODEL_YEAR]
+_PLACEHOLDER_RE: Final = re.compile(r"\[[A-Z_]{3,}\]")
+
+_META_PROMPT_PREFIX_BLAKE2: Final[bytes] = hashlib.blake2b(_META_PROMPT_PREFIX.encode("utf-8"), digest_size=16).digest()
+
+def _prompt_digest(prompt: str) -> bytes:
+    """16-byte digest of a prompt, reusing the precomputed one for the main template"""
+    if prompt is AUTOMOTIVE_PROMPT_TEMPLATE:
+        return template_cache_key()
+    return hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).digest()
+
+def _populated_prompt_cache_path(image_paths: List[str], template_prompt: str) -> Path:
+    """Cache file for a Stage 1 result, keyed by the prompt and image contents"""
+    key = hashlib.blake2b(
+        _META_PROMPT_PREFIX_BLAKE2 + b"|" + _prompt_digest(template_prompt) + b"|"
+        + b"|".join(_file_digest(p) for p in image_paths),
+        digest_size=16,
+    ).hexdigest()
+    return CACHE_DIR / "populated" / f"{key}.txt"
+
+async def _read_cached_prompt(cache_path: Path) -> Optional[str]:
+    """Return a cached populated prompt, or None on a miss"""
+    try:
+        async with aiofiles.open(cache_path, 'r', encoding='utf-8') as f:
+            prompt = await f.read()
+    except FileNotFoundError:
+        return None
+    if not prompt.strip():
+        return None
+    
+    # Bump mtime so pruning evicts least recently used entries first
+    with contextlib.suppress(OSError):
+        os.utime(cache_path)
+    return prompt
+
+def _prune_prompt_cache(cache_dir: Path, max_entries: int):
+    """Delete the least recently used cached prompts beyond max_entries"""
+    entries = []
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.name.endswith(".txt"):
+                with contextlib.suppress(FileNotFoundError):
+                    entries.append((entry.stat().st_mtime, entry.path))
+    
+    if len(entries) <= max_entries:
+        return
+    entries.sort()
+    for _, path in entries[:len(entries) - max_entries]:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+async def _write_cached_prompt(cache_path: Path, prompt: str):
+    """Write a populated prompt to the cache atomically (tmp file + rename)"""
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{uuid4().hex}.tmp")
+    async with aiofiles.open(tmp_path, 'w', encoding='utf-8') as f:
+        await f.write(prompt)
+    os.replace(tmp_path, cache_path)
+    await asyncio.to_thread(_prune_prompt_cache, cache_path.parent, PROMPT_CACHE_MAX_ENTRIES)
+
+async def populate_prompt_with_flash(
+    image_paths: List[str],
+    template_prompt: str,
+    image_parts: Optional[list] = None,
+) -> str:
     """
     Stage 1: Use Gemini 2.5 Flash to analyze images and populate prompt template.
     Replaces [VEHICLE_MAKE_MODEL_YEAR] and [VISIBLE_MODIFICATIONS] with actual details.
+    Pass image_parts to reuse parts already loaded for Stage 2.
     """
     client = get_google_client()
     
     # Meta-prompt that instructs Flash to fill in the template
-    meta_prompt = """Analyze the input image and use it to replace the bracketed example descriptors in the prompt below with accurate, image-grounded descriptions of the vehicle shown. Replace only the text inside square brackets [...]. Do not change sentence structure, ordering, or wording outside those brackets. Do not add new descriptions or remove any constraints. Do not mention tools, models, or reasoning. Return the full prompt with the bracketed descriptors replaced.
-
-Prompt to Populate:
-
-""" + template_prompt
+    meta_prompt = f"{_META_PROMPT_PREFIX}{template_prompt}"
+    
+    # Same images and template always populate to the same prompt
+    cache_path = await asyncio.to_thread(_populated_prompt_cache_path, image_paths, template_prompt)
+    cached_prompt = await _read_cached_prompt(cache_path)
+    if cached_prompt is not None:
+        logger.info(f"✓ Stage 1: Using cached populated prompt ({cache_path.name})")
+        return cached_prompt
     
     # Load images
+    if image_parts is None:
+        image_parts = await _load_parts(image_paths)
     contents = [meta_prompt]
-    for img_path in image_paths:
-        img = Image.open(img_path)
-        contents.append(img)
+    contents.extend(image_parts)
     
     logger.info("Stage 1: Analyzing images with Gemini 2.5 Flash to populate prompt template...")
     logger.info("=" * 80)
@@ -157,18 +370,22 @@ Prompt to Populate:
     logger.info("=" * 80)
     
     try:
-        response = await asyncio.to_thread(
-            client.models.generate_content,
-            model="gemini-3-flash-preview",
-            contents=contents,
-            config=types.GenerateContentConfig(
-                response_modalities=["TEXT"],
-                temperature=0.1,
-            ),
-        )
+        async with _LIMITER.request(estimated_tokens=len(meta_prompt) // 4), asyncio.timeout(GEMINI_CALL_TIMEOUT_S):
+            response = await asyncio.to_thread(
+                client.models.generate_content,
+                model="gemini-3-flash-preview",
+                contents=contents,
+                config=types.GenerateContentConfig(
+                    response_modalities=["TEXT"],
+                    temperature=0.1,
+                ),
+            )
         
         # Extract text response
-        populated_prompt = response.text.strip()
+        populated_prompt = (response.text or "").strip()
+        if not populated_prompt:
+            logger.warning("Flash returned an empty prompt, falling back to original template prompt")
+            return template_prompt
         logger.info(f"✓ Prompt populated with vehicle details")
         logger.info("=" * 80)
         logger.info("STAGE 1 OUTPUT (Populated Prompt):")
@@ -176,6 +393,11 @@ Prompt to Populate:
         logger.info(populated_prompt)
         logger.info("=" * 80)
         
+        try:
+            await _write_cached_prompt(cache_path, populated_prompt)
+        except OSError as e:
+            logger.warning(f"Could not cache populated prompt: {e}")
+        
         return populated_prompt
         
     except Exception as e:
@@ -183,6 +405,93 @@ Prompt to Populate:
         logger.warning("Falling back to original template prompt")
         return template_prompt
 
+_BATCH_POLL_INTERVAL: Final = float(os.getenv("GEMINI_BATCH_POLL_INTERVAL", "30"))
+_BATCH_DONE_STATES: Final = frozenset({
+    "JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED",
+})
+
+def _load_bytes_part(path: str) -> types.Part:
+    """Like _load_part, but formats Gemini doesn't take as raw bytes are re-encoded as PNG"""
+    part = _load_part(path)
+    if isinstance(part, types.Part):
+        return part
+    
+    buffer = BytesIO()
+    with part:
+        part.save(buffer, format="PNG")
+    return types.Part.from_bytes(data=buffer.getvalue(), mime_type="image/png")
+
+async def populate_prompts_batch(jobs: List[tuple[List[str], str]]) -> List[str]:
+    """
+    Stage 1 for several vehicles at once via Gemini batch mode.
+    Each job is (image_paths, template_prompt); results come back in the same order.
+    Batch jobs are queued server-side, so this is meant for bulk runs, not interactive ones.
+    """
+    results: List[Optional[str]] = [None] * len(jobs)
+    cache_paths = []
+    for i, (image_paths, template_prompt) in enumerate(jobs):
+        cache_path = await asyncio.to_thread(_populated_prompt_cache_path, image_paths, template_prompt)
+        cache_paths.append(cache_path)
+        results[i] = await _read_cached_prompt(cache_path)
+    
+    pending = [i for i, r in enumerate(results) if r is None]
+    if len(pending) <= 1:
+        # Not worth a batch round-trip
+        for i in pending:
+            results[i] = await populate_prompt_with_flash(*jobs[i])
+        return results
+    
+    client = get_google_client()
+    try:
+        batch_requests = [
+            types.InlinedRequest(
+                contents=[types.Content(role="user", parts=[
+                    types.Part.from_text(text=f"{_META_PROMPT_PREFIX}{jobs[i][1]}"),
+                    *await asyncio.gather(*[asyncio.to_thread(_load_bytes_part, p) for p in jobs[i][0]]),
+                ])],
+                config=types.GenerateContentConfig(response_modalities=["TEXT"], temperature=0.1),
+            )
+            for i in pending
+        ]
+        
+        logger.info(f"Stage 1: Submitting batch of {len(batch_requests)} prompts to Gemini Flash...")
+        batch_job = await asyncio.to_thread(
+            client.batches.create,
+            model="gemini-3-flash-preview",
+            src=batch_requests,
+            config={"display_name": f"stage1-{uuid4().hex[:8]}"},
+        )
+        while batch_job.state.name not in _BATCH_DONE_STATES:
+            await asyncio.sleep(_BATCH_POLL_INTERVAL)
+            batch_job = await asyncio.to_thread(client.batches.get, name=batch_job.name)
+        
+        if batch_job.state.name != "JOB_STATE_SUCCEEDED":
+            raise RuntimeError(f"batch {batch_job.name} ended in {batch_job.state.name}")
+        
+        for i, inlined in zip(pending, batch_job.dest.inlined_responses):
+            text = inlined.response.text if inlined.response is not None else None
+            if not text or not text.strip():
+                logger.warning(f"Stage 1 batch item {i} returned no text: {inlined.error}")
+                continue
+            results[i] = text.strip()
+            try:
+                await _write_cached_prompt(cache_paths[i], results[i])
+            except OSError as e:
+                logger.warning(f"Could not cache populated prompt: {e}")
+        logger.info(f"✓ Stage 1 batch {batch_job.name} complete")
+    except Exception as e:
+        logger.error(f"Stage 1 batch failed: {e}")
+    
+    # Same fallback as the single-shot path
+    return [r if r is not None else jobs[i][1] for i, r in enumerate(results)]
+
+def _transcode_image(data: bytes, output_path: str, output_format: str):
+    """Re-encode image bytes into output_format (only used when Gemini's format differs)"""
+    with Image.open(BytesIO(data)) as img:
+        if output_format == "jpeg" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.save(output_path, format=output_format.upper())
+
 async def generate_image(
     prompt: str,
     image_paths: List[str],
@@ -213,17 +522,17 @@ async def generate_image(
         # Get Gemini client
         client = get_google_client()
         
+        # Images are read once per call and shared by Stage 1 and Stage 2
+        image_parts = await _load_parts(image_paths)
+        
         # Stage 1: Populate prompt with Flash (if enabled and template has placeholders)
         final_prompt = prompt
-        if use_two_stage and "[VEHICLE_MAKE_MODEL_YEAR]" in prompt:
-            final_prompt = await populate_prompt_with_flash(image_paths, prompt)
+        if use_two_stage and _PLACEHOLDER_RE.search(prompt):
+            final_prompt = await populate_prompt_with_flash(image_paths, prompt, image_parts)
         
         # Stage 2: Generate image with Pro
-        # Load images as PIL Image objects
         contents = [final_prompt]
-        for img_path in image_paths:
-            img = Image.open(img_path)
-            contents.append(img)
+        contents.extend(image_parts)
         
         # Build config with image settings
         config_params = {
@@ -246,31 +555,36 @@ async def generate_image(
         logger.info(final_prompt)
         logger.info("=" * 80)
         
-        try:
-            response = await asyncio.to_thread(
-                client.models.generate_content,
-                model=model_name,
-                contents=contents,
-                config=config,
-            )
-        except Exception as e:
-            logger.warning(f"Gemini call failed: {e}, retrying with flash model...")
-            
-            # Fallback to flash model
-            model_name = "gemini-2.5-flash-image"
-            config = types.GenerateContentConfig(
-                response_modalities=["IMAGE"],
-                image_config=types.ImageConfig(
-                    aspect_ratio=aspect_ratio_str,
-                    image_size="1K"  # Flash doesn't support 2K
-                ),
-            )
-            response = await asyncio.to_thread(
-                client.models.generate_content,
-                model=model_name,
-                contents=contents,
-                config=config,
-            )
+        # Cap concurrent Stage 2 image generations
+        async with _GEMINI_IMG_SEMA:
+            try:
+                async with _LIMITER.request(estimated_tokens=len(final_prompt) // 4), asyncio.timeout(GEMINI_CALL_TIMEOUT_S):
+                    response = await asyncio.to_thread(
+                        client.models.generate_content,
+                        model=model_name,
+                        contents=contents,
+                        config=config,
+                    )
+            except Exception as e:
+                reason = f"timed out after {GEMINI_CALL_TIMEOUT_S}s" if isinstance(e, TimeoutError) else f"failed: {e}"
+                logger.warning(f"Gemini call {reason}, retrying with flash model...")
+                
+                # Fallback to flash model
+                model_name = "gemini-2.5-flash-image"
+                config = types.GenerateContentConfig(
+                    response_modalities=["IMAGE"],
+                    image_config=types.ImageConfig(
+                        aspect_ratio=aspect_ratio_str,
+                        image_size="1K"  # Flash doesn't support 2K
+                    ),
+                )
+                async with _LIMITER.request(estimated_tokens=len(final_prompt) // 4), asyncio.timeout(GEMINI_CALL_TIMEOUT_S):
+                    response = await asyncio.to_thread(
+                        client.models.generate_content,
+                        model=model_name,
+                        contents=contents,
+                        config=config,
+                    )
         
         # Extract image from response
         if not response:
@@ -278,7 +592,12 @@ async def generate_image(
             raise ValueError("No response from Gemini API")
         
         if not hasattr(response, 'parts'):
-            logger.error(f"Response has no 'parts' attribute. Response type: {type(response)}, dir: {dir(response)}")
+            logger.error(
+                "Response has no 'parts' attribute. type=%s candidates=%s feedback=%s",
+                type(response).__name__,
+                getattr(response, 'candidates', None),
+                getattr(response, 'prompt_feedback', None),
+            )
             raise ValueError("Response missing 'parts' attribute")
         
         if response.parts is None:
@@ -291,12 +610,16 @@ async def generate_image(
             raise ValueError("Response.parts is None - image generation may have been blocked or failed")
         
         for part in response.parts:
-            if image := part.as_image():
-                # Google API returns an Image object, save it directly
+            inline = part.inline_data
+            if inline and inline.data:
                 Path(output_path).parent.mkdir(parents=True, exist_ok=True)
                 
-                # Save the image directly
-                await asyncio.to_thread(image.save, output_path)
+                if inline.mime_type == f"image/{output_format_str}":
+                    # Already encoded in the requested format, write the bytes as-is
+                    await asyncio.to_thread(Path(output_path).write_bytes, inline.data)
+                else:
+                    logger.info(f"Transcoding {inline.mime_type} to {output_format_str}")
+                    await asyncio.to_thread(_transcode_image, inline.data, output_path, output_format_str)
                 
                 latency = round(time.perf_counter() - start_time, 3)
                 logger.info(f"✓ Image saved to {output_path} ({latency}s, {image_size} resolution)")
@@ -317,11 +640,71 @@ async def generate_image(
             "error": str(e),
         }
 
+# ============================================================================
+# SHARED HTTP SESSION
+# ============================================================================
+
+_HTTP_SESSION: Optional[aiohttp.ClientSession] = None
+
+async def _get_http_session() -> aiohttp.ClientSession:
+    """
+    Get or create the aiohttp session shared by all outbound HTTP calls.
+    A new session is made if the old one was closed or belongs to another event loop.
+    """
+    global _HTTP_SESSION
+    loop = asyncio.get_running_loop()
+    if _HTTP_SESSION is None or _HTTP_SESSION.closed or _HTTP_SESSION._loop is not loop:
+        _HTTP_SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=64, limit_per_host=64, ttl_dns_cache=300, keepalive_timeout=60),
+        )
+    return _HTTP_SESSION
+
+async def close_http_session():
+    """Close the shared aiohttp session (call on shutdown)"""
+    global _HTTP_SESSION
+    if _HTTP_SESSION is not None and not _HTTP_SESSION.closed:
+        await _HTTP_SESSION.close()
+    _HTTP_SESSION = None
+
 # ============================================================================
 # IMGBB IMAGE HOSTING
 # ============================================================================
 
+# ImgBB URLs are stable, so identical bytes only need uploading once
+_IMGBB_TTL_SECONDS: Final = 1800
+_IMGBB_UPLOADS: Dict[bytes, tuple[float, asyncio.Task]] = {}
+
 async def upload_to_imgbb(image_path: str) -> str:
+    """
+    Upload image to ImgBB and return public URL.
+    Uploads are keyed by content hash; concurrent and repeat callers share one upload.
+    """
+    digest = await asyncio.to_thread(_file_digest, image_path)
+    now = time.monotonic()
+    loop = asyncio.get_running_loop()
+    
+    entry = _IMGBB_UPLOADS.get(digest)
+    stale = entry is None or now - entry[0] > _IMGBB_TTL_SECONDS or entry[1].get_loop() is not loop
+    if not stale and entry[1].done():
+        stale = entry[1].cancelled() or entry[1].exception() is not None
+    if stale:
+        for key in [k for k, (ts, _) in _IMGBB_UPLOADS.items() if now - ts > _IMGBB_TTL_SECONDS]:
+            del _IMGBB_UPLOADS[key]
+        entry = (now, loop.create_task(_upload_to_imgbb(image_path)))
+        _IMGBB_UPLOADS[digest] = entry
+    else:
+        logger.info(f"Reusing ImgBB upload for {Path(image_path).name}")
+    
+    task = entry[1]
+    try:
+        # Shielded so one cancelled caller doesn't cancel the shared upload
+        return await asyncio.shield(task)
+    except Exception:
+        if _IMGBB_UPLOADS.get(digest) is entry:
+            del _IMGBB_UPLOADS[digest]
+        raise
+
+async def _upload_to_imgbb(image_path: str) -> str:
     """
     Upload image to ImgBB and return public URL.
     ImgBB provides free image hosting with public URLs.
@@ -329,34 +712,25 @@ async def upload_to_imgbb(image_path: str) -> str:
     if not IMGBB_API_KEY:
         raise ValueError("IMGBB_API_KEY is not configured in .env file. Get one free at https://api.imgbb.com/")
     
-    import base64
+    # Check image dimensions before upload (header only, no pixel decode)
+    with Image.open(image_path) as img:
+        logger.info(f"Image {Path(image_path).name}: {img.width}x{img.height} ({img.mode})")
     
-    # Check image dimensions before upload
-    img = Image.open(image_path)
-    logger.info(f"Image {Path(image_path).name}: {img.width}x{img.height} ({img.mode})")
-    
-    # Read and encode image
-    with open(image_path, 'rb') as f:
-        img_bytes = f.read()
-    
-    b64_image = base64.b64encode(img_bytes).decode('utf-8')
-    
-    # Upload to ImgBB
+    # Upload to ImgBB as a multipart file, no base64 pass needed
     url = "https://api.imgbb.com/1/upload"
-    payload = {
-        "key": IMGBB_API_KEY,
-        "image": b64_image,
-    }
     
     logger.info(f"Uploading {Path(image_path).name} to ImgBB...")
     
-    def _upload():
-        response = requests.post(url, data=payload, timeout=60)
-        response.raise_for_status()
-        return response.json()
-    
     try:
-        result = await asyncio.to_thread(_upload)
+        session = await _get_http_session()
+        with open(image_path, 'rb') as f:
+            form = aiohttp.FormData()
+            form.add_field("key", IMGBB_API_KEY)
+            form.add_field("image", f, filename=Path(image_path).name)
+            
+            async with session.post(url, data=form, timeout=aiohttp.ClientTimeout(total=60)) as response:
+                response.raise_for_status()
+                result = await response.json()
         
         if result.get("success"):
             image_url = result["data"]["url"]
@@ -377,6 +751,13 @@ DEFAULT_MODEL_PATH = "kling-video/v2.6/pro/image-to-video"
 DEFAULT_DURATION_SECONDS = 5
 MAX_RETRIES = 3
 
+# Concurrent video generations (ImgBB upload + Higgsfield submit/poll/download)
+_VIDEO_SEMA = asyncio.Semaphore(int(os.getenv("HF_MAX_CONCURRENT", "6")))
+
+# Higgsfield submissions per minute (request count only, no token budget)
+HF_SUBMIT_RPM = int(os.getenv("HF_SUBMIT_RPM", "30"))
+_HF_LIMITER = SlidingWindowRateLimiter(rpm=HF_SUBMIT_RPM)
+
 class VideoGenerationError(Exception):
     """Raised when video generation fails after retries."""
 
@@ -386,14 +767,14 @@ def _build_endpoint(model_name: str) -> str:
         return model_name
     return f"https://platform.higgsfield.ai/{model_name.lstrip('/')}"
 
-async def _download_bytes(url: str, *, timeout: int = 180) -> bytes:
-    """Download binary content."""
-    def _fetch() -> bytes:
-        resp = requests.get(url, stream=True, timeout=timeout)
+async def _download_to_file(url: str, dest: Path, timeout: int = 180) -> None:
+    """Stream binary content straight to a file, 64 KiB at a time."""
+    session = await _get_http_session()
+    async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
         resp.raise_for_status()
-        return resp.content
-    
-    return await asyncio.to_thread(_fetch)
+        async with aiofiles.open(dest, 'wb') as f:
+            async for chunk in resp.content.iter_chunked(1 << 16):
+                await f.write(chunk)
 
 async def _submit_generation_request(
     start_image_path: str,
@@ -408,8 +789,14 @@ async def _submit_generation_request(
     
     logger.info(f"Submitting generation to Higgsfield: {model_name}")
     
-    # Upload images to ImgBB to get public URLs
-    start_image_url = await upload_to_imgbb(start_image_path)
+    # Upload images to ImgBB to get public URLs (start and end concurrently)
+    if end_image_path:
+        start_image_url, end_image_url = await asyncio.gather(
+            upload_to_imgbb(start_image_path),
+            upload_to_imgbb(end_image_path),
+        )
+    else:
+        start_image_url = await upload_to_imgbb(start_image_path)
     
     payload: Dict[str, Any] = {
         "image_url": start_image_url,
@@ -420,7 +807,6 @@ async def _submit_generation_request(
     }
     
     if end_image_path:
-        end_image_url = await upload_to_imgbb(end_image_path)
         payload["last_image_url"] = end_image_url
     
     headers = {
@@ -432,28 +818,38 @@ async def _submit_generation_request(
     timeout = aiohttp.ClientTimeout(total=300)
     endpoint = _build_endpoint(model_name)
     
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        async with session.post(endpoint, headers=headers, json=payload) as response:
-            if response.status == 200:
-                data = await response.json()
-                return {
-                    "success": True,
-                    "status_url": data.get("status_url"),
-                    "request_id": data.get("request_id"),
-                }
-            
-            error_text = await response.text()
-            if response.status == 403:
-                logger.error("Higgsfield API 403 error: %s", error_text)
-                if "not enough credits" in error_text.lower():
-                    return {"success": False, "error": "insufficient_credits", "details": error_text}
-                return {"success": False, "error": "forbidden", "details": error_text}
-            
-            if response.status >= 500:
-                logger.error("Higgsfield API server error: %s", error_text)
-                return {"success": False, "error": f"server_error_{response.status}", "details": error_text}
-            
-            return {"success": False, "error": f"client_error_{response.status}", "details": error_text}
+    session = await _get_http_session()
+    await _HF_LIMITER.acquire()
+    async with session.post(endpoint, headers=headers, json=payload, timeout=timeout) as response:
+        if response.status == 200:
+            data = await response.json()
+            return {
+                "success": True,
+                "status_url": data.get("status_url"),
+                "request_id": data.get("request_id"),
+            }
+        
+        error_text = await response.text()
+        if response.status == 403:
+            logger.error("Higgsfield API 403 error: %s", error_text)
+            if "not enough credits" in error_text.lower():
+                return {"success": False, "error": "insufficient_credits", "details": error_text}
+            return {"success": False, "error": "forbidden", "details": error_text}
+        
+        if response.status >= 500:
+            logger.error("Higgsfield API server error: %s", error_text)
+            return {"success": False, "error": f"server_error_{response.status}", "details": error_text}
+        
+        return {"success": False, "error": f"client_error_{response.status}", "details": error_text}
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given in seconds. HTTP-date values are ignored."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
 
 async def _poll_status(
     status_url: str,
@@ -470,46 +866,52 @@ async def _poll_status(
     }
     
     start_time = time.time()
-    poll_interval = 2.0
+    poll_interval = 8.0
     timeout = aiohttp.ClientTimeout(total=30)
     
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        while True:
-            elapsed = time.time() - start_time
-            if elapsed > max_wait_time:
-                return {"success": False, "error": "poll_timeout"}
-            
-            try:
-                async with session.get(status_url, headers=headers) as response:
-                    if response.status == 200:
-                        status_data = await response.json()
-                        status = status_data.get("status")
-                        
-                        if status == "completed":
-                            video_info = status_data.get("video") or {}
-                            video_url = video_info.get("url")
-                            if video_url:
-                                return {"success": True, "video_url": video_url}
-                            return {"success": False, "error": "missing_video_url"}
-                        
-                        if status == "failed":
-                            return {"success": False, "error": status_data.get("error", "generation_failed")}
-                        
-                        poll_interval = min(poll_interval * 1.2, 10)
-                        await asyncio.sleep(poll_interval)
-                        continue
+    # Kling videos take at least ~30s, so don't spend requests before then
+    await asyncio.sleep(min(30, max_wait_time))
+    
+    session = await _get_http_session()
+    while True:
+        elapsed = time.time() - start_time
+        if elapsed > max_wait_time:
+            return {"success": False, "error": "poll_timeout"}
+        
+        delay = poll_interval
+        try:
+            async with session.get(status_url, headers=headers, timeout=timeout) as response:
+                if response.status == 200:
+                    status_data = await response.json()
+                    status = status_data.get("status")
+                    
+                    if status == "completed":
+                        video_info = status_data.get("video") or {}
+                        video_url = video_info.get("url")
+                        if video_url:
+                            return {"success": True, "video_url": video_url}
+                        return {"success": False, "error": "missing_video_url"}
                     
-                    if response.status >= 500:
-                        await asyncio.sleep(poll_interval)
-                        continue
+                    if status == "failed":
+                        return {"success": False, "error": status_data.get("error", "generation_failed")}
                     
+                    # Prefer the server's hint for when to check again
+                    retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+                    if retry_after is not None:
+                        # Floor it so "Retry-After: 0" can't spin, and don't sleep past the deadline
+                        delay = min(max(retry_after, 1.0), max(1.0, max_wait_time - elapsed))
+                    else:
+                        poll_interval = min(poll_interval * 1.2, 15)
+                        delay = poll_interval
+                
+                elif response.status < 500:
                     error_text = await response.text()
                     return {"success": False, "error": f"poll_error_{response.status}", "details": error_text}
-            except (asyncio.TimeoutError, aiohttp.ClientError):
-                await asyncio.sleep(poll_interval)
-                continue
-            except Exception as exc:
-                return {"success": False, "error": f"unexpected_poll_error: {exc}"}
+        except (asyncio.TimeoutError, aiohttp.ClientError):
+            # Transient; status GETs are idempotent, so just poll again
+            pass
+        
+        await asyncio.sleep(delay)
 
 async def _generate_higgsfield_video(
     prompt: str,
@@ -601,10 +1003,8 @@ async def _generate_higgsfield_video(
             raise VideoGenerationError("Video URL missing from completed job")
         
         # Download video and save locally
-        video_bytes = await _download_bytes(video_url)
         Path(output_path).parent.mkdir(parents=True, exist_ok=True)
-        with open(output_path, 'wb') as f:
-            f.write(video_bytes)
+        await _download_to_file(video_url, Path(output_path))
         
         latency = round(time.perf_counter() - start_time, 3)
         logger.info(f"Video saved to {output_path} ({latency}s)")
@@ -634,19 +1034,25 @@ async def generate_higgsfield(
         duration = DEFAULT_DURATION_SECONDS
     
     try:
-        return await _generate_higgsfield_video(
-            prompt=prompt,
-            start_image_path=start_image_path,
-            end_image_path=end_image_path,
-            output_path=output_path,
-            duration_seconds=duration,
-            model_name=model_name,
-        )
+        async with _VIDEO_SEMA:
+            return await _generate_higgsfield_video(
+                prompt=prompt,
+                start_image_path=start_image_path,
+                end_image_path=end_image_path,
+                output_path=output_path,
+                duration_seconds=duration,
+                model_name=model_name,
+            )
     except Exception as exc:
         logger.exception("Error generating video after retries", exc_info=True)
         return {
             "success": False,
-            "error": str(exc),
+            "error": str(exc) or type(exc).__name__,
+            # Higgsfield submit/poll failures were already retried above (VideoGenerationError);
+            # ImgBB/network/download errors are worth another outer attempt
+            "retryable": isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError)) and not (
+                isinstance(exc, aiohttp.ClientResponseError) and exc.status < 500 and exc.status != 429
+            ),
         }
 
 # ============================================================================
@@ -679,6 +1085,14 @@ All frames must contain NO written text, labels, captions, UI elements, watermar
 
 """
 
+# Encoded once at import so cache keys don't re-encode and re-hash the ~4 KB template
+_TEMPLATE_UTF8: Final[bytes] = AUTOMOTIVE_PROMPT_TEMPLATE.encode("utf-8")
+_TEMPLATE_BLAKE2: Final[bytes] = hashlib.blake2b(_TEMPLATE_UTF8, digest_size=16).digest()
+
+def template_cache_key() -> bytes:
+    """16-byte BLAKE2b digest of AUTOMOTIVE_PROMPT_TEMPLATE, for use in cache keys"""
+    return _TEMPLATE_BLAKE2
+
 # ============================================================================
 # CAMERA MOVEMENT PROMPTS
 # ============================================================================
@@ -701,13 +1115,13 @@ CAMERA_PROMPTS = [
 
 def load_images_from_folder(folder_path: str) -> List[str]:
     """Load all image file paths from a folder."""
-    image_extensions = {'.jpg', '.jpeg', '.png', '.webp', '.bmp'}
-    folder = Path(folder_path)
+    image_extensions = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
     
-    if not folder.exists() or not folder.is_dir():
+    if not os.path.isdir(folder_path):
         raise ValueError(f"Folder not found: {folder_path}")
     
-    image_files = [str(f) for f in folder.iterdir() if f.suffix.lower() in image_extensions]
+    with os.scandir(folder_path) as entries:
+        image_files = [e.path for e in entries if e.is_file() and e.name.lower().endswith(image_extensions)]
     
     if not image_files:
         raise ValueError(f"No image files found in {folder_path}")
@@ -715,61 +1129,155 @@ def load_images_from_folder(folder_path: str) -> List[str]:
     logger.info(f"Found {len(image_files)} images in {folder_path}")
     return image_files
 
-def crop_contact_sheet(contact_sheet_path: str, output_dir: str) -> List[str]:
-    """Crop a 3x3 contact sheet into 9 individual frames and resize for Kling compatibility."""
-    img = Image.open(contact_sheet_path)
-    width, height = img.size
-    
-    frame_width = width // 3
-    frame_height = height // 3
-    
+# Kling requires dimensions divisible by 8, with common sizes being:
+# 1024x576 (16:9), 576x1024 (9:16), 768x768 (1:1), 1280x720 (16:9)
+# We'll use 1024x576 (16:9) as it's a good horizontal format for cars
+TARGET_WIDTH = 1024
+TARGET_HEIGHT = 576
+
+def _crop_one_vips(sheet: "pyvips.Image", frame_num: int, output_dir_path: Path) -> str:
+    """libvips version of _crop_one: SIMD Lanczos resize, no intermediate PIL copies"""
+    frame_width = sheet.width // 3
+    frame_height = sheet.height // 3
+    row, col = divmod(frame_num - 1, 3)
+    
+    resized = sheet.crop(col * frame_width, row * frame_height, frame_width, frame_height)
+    if (frame_width, frame_height) != (TARGET_WIDTH, TARGET_HEIGHT):
+        resized = resized.thumbnail_image(TARGET_WIDTH, height=TARGET_HEIGHT, size="force")
+    
+    output_path = output_dir_path / f"frame_{frame_num:02d}.png"
+    resized.write_to_file(str(output_path), compression=1)
+    logger.info(f"Cropped and resized frame {frame_num} to {TARGET_WIDTH}x{TARGET_HEIGHT}: {output_path}")
+    return str(output_path)
+
+def _crop_one(args: tuple) -> str:
+    """Resize and save one tile of the shared contact sheet (runs in a worker process)"""
+    shm_name, shape, row, col, frame_num, output_dir_path = args
+    shm = SharedMemory(name=shm_name)
+    try:
+        sheet = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        frame_height, frame_width = shape[0] // 3, shape[1] // 3
+        
+        # All 9 tiles as views of the sheet: (row, col, y, x, channel)
+        tiles = sheet[:frame_height * 3, :frame_width * 3].reshape(
+            3, frame_height, 3, frame_width, shape[2]
+        ).swapaxes(1, 2)
+        tile = Image.fromarray(np.ascontiguousarray(tiles[row, col]))
+        del sheet, tiles  # release the shared buffer before closing it
+    finally:
+        shm.close()
+    
+    # Resize to Kling-compatible dimensions (1024x576, 16:9)
+    # Use LANCZOS for high-quality resizing; a 3072x1728 sheet already has target-sized tiles
+    resized = tile
+    if tile.size != (TARGET_WIDTH, TARGET_HEIGHT):
+        # reducing_gap: box-reduce by an integer factor first, then LANCZOS the rest
+        resized = tile.resize((TARGET_WIDTH, TARGET_HEIGHT), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    
+    output_path = output_dir_path / f"frame_{frame_num:02d}.png"
+    # Kling re-encodes the frames anyway, so favour encode speed over file size
+    resized.save(output_path, format='PNG', compress_level=1, optimize=False)
+    logger.info(f"Cropped and resized frame {frame_num} to {TARGET_WIDTH}x{TARGET_HEIGHT}: {output_path}")
+    return str(output_path)
+
+def _load_sheet_to_shm(contact_sheet_path: str) -> tuple[SharedMemory, tuple]:
+    """Decode the contact sheet once into shared memory for the crop workers"""
+    with Image.open(contact_sheet_path) as img:
+        if img.format == "JPEG":
+            # Let libjpeg downscale while decoding (DCT scaling), never below the 3x3 target size
+            img.draft("RGB", (TARGET_WIDTH * 3, TARGET_HEIGHT * 3))
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGB")
+        pixels = np.asarray(img)
+    
+    shm = SharedMemory(create=True, size=pixels.nbytes)
+    np.ndarray(pixels.shape, dtype=np.uint8, buffer=shm.buf)[:] = pixels
+    return shm, pixels.shape
+
+async def iter_cropped_frames(contact_sheet_path: str, output_dir: str) -> AsyncIterator[tuple[int, str]]:
+    """
+    Crop a 3x3 contact sheet into 9 frames resized for Kling compatibility.
+    Yields (frame_num, path) as each frame is written, in completion order.
+    output_dir must already exist.
+    """
     output_dir_path = Path(output_dir)
-    output_dir_path.mkdir(parents=True, exist_ok=True)
-    
-    cropped_frames = []
-    frame_num = 0
-    
-    # Kling requires dimensions divisible by 8, with common sizes being:
-    # 1024x576 (16:9), 576x1024 (9:16), 768x768 (1:1), 1280x720 (16:9)
-    # We'll use 1024x576 (16:9) as it's a good horizontal format for cars
-    TARGET_WIDTH = 1024
-    TARGET_HEIGHT = 576
-    
-    for row in range(3):
-        for col in range(3):
-            frame_num += 1
-            left = col * frame_width
-            top = row * frame_height
-            right = left + frame_width
-            bottom = top + frame_height
-            
-            cropped = img.crop((left, top, right, bottom))
-            
-            # Resize to Kling-compatible dimensions (1024x576, 16:9)
-            # Use LANCZOS for high-quality resizing
-            resized = cropped.resize((TARGET_WIDTH, TARGET_HEIGHT), Image.Resampling.LANCZOS)
-            
-            output_path = output_dir_path / f"frame_{frame_num:02d}.png"
-            resized.save(output_path, format='PNG')
-            cropped_frames.append(str(output_path))
-            logger.info(f"Cropped and resized frame {frame_num} to {TARGET_WIDTH}x{TARGET_HEIGHT}: {output_path}")
     
-    return cropped_frames
+    if pyvips is not None:
+        # Default (random) access: tiles are read out of row order
+        sheet = await asyncio.to_thread(pyvips.Image.new_from_file, contact_sheet_path)
+        for frame_num in range(1, 10):
+            yield frame_num, await asyncio.to_thread(_crop_one_vips, sheet, frame_num, output_dir_path)
+        return
+    
+    # Workers slice their tile from shared memory without re-decoding the sheet or pickling pixels
+    shm, shape = await asyncio.to_thread(_load_sheet_to_shm, contact_sheet_path)
+    try:
+        # Tiles are independent and CPU-bound (resize + PNG deflate), so fan out across processes
+        with ProcessPoolExecutor(max_workers=min(9, os.cpu_count() or 1), initializer=_init_worker_logging) as executor:
+            pending = {
+                asyncio.wrap_future(executor.submit(_crop_one, (shm.name, shape, row, col, row * 3 + col + 1, output_dir_path))): row * 3 + col + 1
+                for row in range(3)
+                for col in range(3)
+            }
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+    finally:
+        shm.close()
+        shm.unlink()
+
+# Failures worth another attempt: rate limits, 5xx and timeouts (HTTP and Gemini API errors).
+# Higgsfield server_error/poll_timeout are left out: _generate_higgsfield_video already retries them
+_RETRYABLE_ERROR_RE: Final = re.compile(
+    r"\b429\b|\b5\d\d\b|timed? ?out|rate.?limit|resource.?exhausted|unavailable|overloaded",
+    re.IGNORECASE,
+)
+STEP_MAX_ATTEMPTS = int(os.getenv("STEP_MAX_ATTEMPTS", "3"))
+
+def _is_retryable(error: str) -> bool:
+    """Whether a failed result's error looks transient"""
+    return bool(_RETRYABLE_ERROR_RE.search(error))
+
+async def _retry_with_backoff(label: str, call: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+    """
+    Run `call` (which returns a {"success": ...} result) up to STEP_MAX_ATTEMPTS times,
+    sleeping with exponential backoff + jitter between transient failures.
+    A result's explicit "retryable" flag wins; otherwise the error text decides.
+    """
+    for attempt in range(STEP_MAX_ATTEMPTS):
+        result = await call()
+        error = str(result.get("error", ""))
+        retryable = result.get("retryable")
+        if retryable is None:
+            retryable = _is_retryable(error)
+        if result.get("success") or attempt == STEP_MAX_ATTEMPTS - 1 or not retryable:
+            return result
+        
+        delay = min(60, 2 ** attempt + random.random())
+        logger.warning(f"{label} failed ({error}), retrying in {delay:.1f}s ({attempt + 2}/{STEP_MAX_ATTEMPTS})")
+        await asyncio.sleep(delay)
 
 async def generate_videos_from_frames(frame_paths: List[str], output_dir: str) -> List[Dict[str, Any]]:
-    """Generate videos using consecutive frames as start/end images with batch concurrency."""
+    """Generate videos using consecutive frames as start/end images, concurrency capped by _VIDEO_SEMA."""
     if len(frame_paths) != 9:
         raise ValueError(f"Expected 9 frames, got {len(frame_paths)}")
     
     videos = []
     
-    # Create all video generation tasks
-    async def generate_single_video(i: int):
-        start_frame = frame_paths[i]
-        end_frame = frame_paths[i + 1]
-        prompt = CAMERA_PROMPTS[i] if i < len(CAMERA_PROMPTS) else CAMERA_PROMPTS[-1]
-        output_path = Path(output_dir) / f"video_segment_{i+1:02d}.mp4"
-        
+    # (prompt, start frame, end frame, output path) for each of the 8 segments
+    output_dir_path = Path(output_dir)
+    plan = [
+        (
+            CAMERA_PROMPTS[min(i, len(CAMERA_PROMPTS) - 1)],
+            frame_paths[i],
+            frame_paths[i + 1],
+            str(output_dir_path / f"video_segment_{i+1:02d}.mp4"),
+        )
+        for i in range(8)
+    ]
+    
+    async def generate_single_video(i: int, prompt: str, start_frame: str, end_frame: str, output_path: str):
         logger.info(f"Generating video segment {i+1}/8: frame {i+1} -> frame {i+2}")
         logger.info("=" * 80)
         logger.info(f"VIDEO SEGMENT {i+1} PROMPT:")
@@ -777,48 +1285,36 @@ async def generate_videos_from_frames(frame_paths: List[str], output_dir: str) -
         logger.info(prompt)
         logger.info("=" * 80)
         
-        return await generate_higgsfield(
+        return await _retry_with_backoff(f"Video segment {i+1}", lambda: generate_higgsfield(
             prompt=prompt,
             start_image_path=start_frame,
             end_image_path=end_frame,
-            output_path=str(output_path),
+            output_path=output_path,
             duration_seconds=5,
             model_name="kling-video/v2.6/pro/image-to-video",
-        )
-    
-    # Process videos in batches of 3 for safety
-    BATCH_SIZE = 3
-    logger.info(f"Generating videos in batches of {BATCH_SIZE} concurrent requests...")
+        ))
+    
+    # All segments start at once; _VIDEO_SEMA and the submit limiter in
+    # generate_higgsfield start the next one as soon as a slot frees up
+    logger.info("Generating 8 video segments concurrently...")
+    results = await asyncio.gather(
+        *[generate_single_video(i, *segment) for i, segment in enumerate(plan)],
+        return_exceptions=True,
+    )
     
-    for batch_start in range(0, 8, BATCH_SIZE):
-        batch_end = min(batch_start + BATCH_SIZE, 8)
-        batch_indices = range(batch_start, batch_end)
-        
-        logger.info(f"Starting batch: videos {batch_start+1}-{batch_end}")
-        
-        # Generate this batch concurrently
-        batch_tasks = [generate_single_video(i) for i in batch_indices]
-        batch_results = await asyncio.gather(*batch_tasks, return_exceptions=True)
-        
-        # Process results
-        for i, result in zip(batch_indices, batch_results):
-            if isinstance(result, Exception):
-                logger.error(f"Video segment {i+1} failed with exception: {result}")
-                videos.append({
-                    "success": False,
-                    "error": str(result),
-                })
+    for i, result in enumerate(results):
+        if isinstance(result, Exception):
+            logger.error(f"Video segment {i+1} failed with exception: {result}")
+            videos.append({
+                "success": False,
+                "error": str(result),
+            })
+        else:
+            videos.append(result)
+            if result.get("success"):
+                logger.info(f"✓ Video segment {i+1} completed successfully")
             else:
-                videos.append(result)
-                if result.get("success"):
-                    logger.info(f"✓ Video segment {i+1} completed successfully")
-                else:
-                    logger.error(f"✗ Video segment {i+1} failed: {result.get('error')}")
-        
-        # Small delay between batches to be extra safe
-        if batch_end < 8:
-            logger.info(f"Batch complete. Waiting 2 seconds before next batch...")
-            await asyncio.sleep(2)
+                logger.error(f"✗ Video segment {i+1} failed: {result.get('error')}")
     
     return videos
 
@@ -829,20 +1325,29 @@ async def stitch_videos(video_paths: List[str], output_path: str) -> Dict[str, A
         
         logger.info(f"\n[STITCHING] Combining {len(video_paths)} videos into final output...")
         
-        # Create a file list for ffmpeg
-        list_file = Path(output_path).parent / "ffmpeg_list.txt"
-        with open(list_file, 'w') as f:
-            for video_path in video_paths:
-                # Use absolute paths and escape special characters
-                abs_path = Path(video_path).absolute()
-                f.write(f"file '{abs_path}'\n")
+        if len(video_paths) == 1:
+            # Nothing to join; copyfile uses sendfile on Linux, no ffmpeg spawn
+            await asyncio.to_thread(shutil.copyfile, video_paths[0], output_path)
+            logger.info(f"✓ Single segment copied to: {output_path}")
+            return {
+                "success": True,
+                "path": output_path,
+            }
+        
+        # Concat list fed on stdin, no temp file. Absolute paths, with single
+        # quotes escaped for the concat demuxer
+        list_text = "".join(
+            "file '{}'\n".format(str(Path(video_path).absolute()).replace("'", "'\\''"))
+            for video_path in video_paths
+        )
         
         # Run ffmpeg to concatenate videos
         cmd = [
             'ffmpeg',
             '-f', 'concat',
             '-safe', '0',
-            '-i', str(list_file),
+            '-protocol_whitelist', 'file,pipe',
+            '-i', 'pipe:0',
             '-c', 'copy',  # Copy codec (fast, no re-encoding)
             '-y',  # Overwrite output
             str(output_path)
@@ -853,13 +1358,11 @@ async def stitch_videos(video_paths: List[str], output_path: str) -> Dict[str, A
         result = await asyncio.to_thread(
             subprocess.run,
             cmd,
+            input=list_text,
             capture_output=True,
             text=True
         )
         
-        # Clean up temp file
-        list_file.unlink()
-        
         if result.returncode == 0:
             logger.info(f"✓ Final stitched video saved to: {output_path}")
             return {
@@ -889,9 +1392,29 @@ async def stitch_videos(video_paths: List[str], output_path: str) -> Dict[str, A
             "error": str(e),
         }
 
-async def upscale_frames(frame_paths: List[str], output_dir: str) -> List[str]:
-    """Upscale individual frames using Gemini image generation."""
-    logger.info(f"Upscaling {len(frame_paths)} frames...")
+# Local upscale target: 2x the Kling frame, same 16:9 aspect
+UPSCALE_WIDTH = TARGET_WIDTH * 2
+UPSCALE_HEIGHT = TARGET_HEIGHT * 2
+
+def _upscale_vips(frame_path: str, output_path: str):
+    """Lanczos upscale with libvips, a local alternative to the Gemini upscale call"""
+    img = pyvips.Image.new_from_file(frame_path)
+    img = img.resize(UPSCALE_WIDTH / img.width, vscale=UPSCALE_HEIGHT / img.height, kernel="lanczos3")
+    img.write_to_file(output_path, compression=1)
+
+async def upscale_frames(
+    frames: AsyncIterable[tuple[int, str]],
+    output_dir: str,
+) -> tuple[List[str], List[str]]:
+    """
+    Upscale individual frames using Gemini image generation.
+    Each (frame_num, path) starts upscaling as soon as it arrives, so cropping and
+    upscaling overlap. Returns (frame_paths, upscaled_paths), both in frame order.
+    output_dir must already exist.
+    """
+    logger.info("Upscaling frames as they are cropped...")
+    if UPSCALE_BACKEND == "vips" and pyvips is None:
+        logger.warning("UPSCALE_BACKEND=vips but pyvips is not available, using Gemini")
     
     upscale_prompt = "Upscale the image, keep all details of the original image exactly the same."
     
@@ -901,17 +1424,23 @@ async def upscale_frames(frame_paths: List[str], output_dir: str) -> List[str]:
     logger.info(upscale_prompt)
     logger.info("=" * 80)
     
-    upscaled_paths = []
-    
     output_dir_path = Path(output_dir)
-    output_dir_path.mkdir(parents=True, exist_ok=True)
     
-    for i, frame_path in enumerate(frame_paths, 1):
+    async def upscale_one(i: int, frame_path: str) -> str:
         output_path = output_dir_path / f"upscaled_frame_{i:02d}.png"
         
-        logger.info(f"Upscaling frame {i}/{len(frame_paths)}...")
+        logger.info(f"Upscaling frame {i}...")
+        
+        if UPSCALE_BACKEND == "vips" and pyvips is not None:
+            try:
+                await asyncio.to_thread(_upscale_vips, frame_path, str(output_path))
+            except Exception as e:
+                logger.warning(f"✗ Frame {i} local upscale failed: {e}, using original frame")
+                return frame_path
+            logger.info(f"✓ Frame {i} upscaled locally to {UPSCALE_WIDTH}x{UPSCALE_HEIGHT}")
+            return str(output_path)
         
-        result = await generate_image(
+        result = await _retry_with_backoff(f"Frame {i} upscale", lambda: generate_image(
             prompt=upscale_prompt,
             image_paths=[frame_path],
             output_path=str(output_path),
@@ -920,16 +1449,35 @@ async def upscale_frames(frame_paths: List[str], output_dir: str) -> List[str]:
             model_name="gemini-3-pro-image-preview",
             image_size="2K",
             use_two_stage=False,  # No need for two-stage on upscale
-        )
+        ))
         
         if result.get("success"):
-            upscaled_paths.append(str(output_path))
             logger.info(f"✓ Frame {i} upscaled successfully")
-        else:
-            logger.warning(f"✗ Frame {i} upscale failed: {result.get('error')}, using original frame")
-            upscaled_paths.append(frame_path)
+            return str(output_path)
+        logger.warning(f"✗ Frame {i} upscale failed: {result.get('error')}, using original frame")
+        return frame_path
     
-    return upscaled_paths
+    # Frames are independent; generate_image's _GEMINI_IMG_SEMA caps how many run at once
+    frame_paths: Dict[int, str] = {}
+    tasks: Dict[int, asyncio.Task] = {}
+    try:
+        async for i, frame_path in frames:
+            frame_paths[i] = frame_path
+            tasks[i] = asyncio.create_task(upscale_one(i, frame_path))
+    except BaseException:
+        # Cropping failed or we were cancelled: don't leave upscales running
+        for task in tasks.values():
+            task.cancel()
+        raise
+    
+    order = sorted(frame_paths)
+    try:
+        upscaled = await asyncio.gather(*[tasks[i] for i in order])
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        raise
+    return [frame_paths[i] for i in order], list(upscaled)
 
 async def process_car_images(
     input_folder: str,
@@ -940,6 +1488,14 @@ async def process_car_images(
     logger.info("Starting Car Video Generation Pipeline - LOCAL STORAGE")
     logger.info("=" * 80)
     
+    # Create every output directory up front; the step helpers assume they exist
+    output_dir_path = Path(output_dir)
+    frames_dir = output_dir_path / "frames"
+    upscaled_dir = output_dir_path / "upscaled_frames"
+    videos_dir = output_dir_path / "videos"
+    for d in (frames_dir, upscaled_dir, videos_dir):
+        os.makedirs(d, exist_ok=True)
+    
     # Step 1: Load input images
     logger.info("\n[STEP 1] Loading car images from folder...")
     car_image_paths = load_images_from_folder(input_folder)
@@ -952,7 +1508,7 @@ async def process_car_images(
     logger.info(AUTOMOTIVE_PROMPT_TEMPLATE[:500] + "..." if len(AUTOMOTIVE_PROMPT_TEMPLATE) > 500 else AUTOMOTIVE_PROMPT_TEMPLATE)
     logger.info("=" * 80)
     
-    contact_sheet_path = Path(output_dir) / "contact_sheet.png"
+    contact_sheet_path = output_dir_path / "contact_sheet.png"
     
     contact_sheet_result = await generate_image(
         prompt=AUTOMOTIVE_PROMPT_TEMPLATE,
@@ -971,19 +1527,17 @@ async def process_car_images(
     
     logger.info(f"Contact sheet saved: {contact_sheet_path}")
     
-    # Step 3: Crop contact sheet
+    # Steps 3 + 4: Crop contact sheet and upscale frames, each frame's upscale
+    # starting as soon as its crop is written
     logger.info("\n[STEP 3] Cropping contact sheet into 9 frames...")
-    frames_dir = Path(output_dir) / "frames"
-    frame_paths = crop_contact_sheet(str(contact_sheet_path), str(frames_dir))
-    
-    # Step 4: Upscale frames
     logger.info("\n[STEP 4] Upscaling frames to 2K resolution (3:2 aspect ratio)...")
-    upscaled_dir = Path(output_dir) / "upscaled_frames"
-    upscaled_frame_paths = await upscale_frames(frame_paths, str(upscaled_dir))
+    frame_paths, upscaled_frame_paths = await upscale_frames(
+        iter_cropped_frames(str(contact_sheet_path), str(frames_dir)),
+        str(upscaled_dir),
+    )
     
     # Step 5: Generate videos
     logger.info("\n[STEP 5] Generating 8 video segments with Kling 2.5-turbo...")
-    videos_dir = Path(output_dir) / "videos"
     videos = await generate_videos_from_frames(upscaled_frame_paths, str(videos_dir))
     
     # Step 6: Stitch videos into final output
@@ -992,7 +1546,7 @@ async def process_car_images(
     final_video_path = None
     if successful_video_paths:
         logger.info(f"\n[STEP 6] Stitching {len(successful_video_paths)} videos into final output...")
-        final_video_path = Path(output_dir) / "final_video.mp4"
+        final_video_path = output_dir_path / "final_video.mp4"
         stitch_result = await stitch_videos(successful_video_paths, str(final_video_path))
         
         if not stitch_result.get("success"):
@@ -1024,6 +1578,14 @@ async def process_car_images(
 # MAIN ENTRY POINT
 # ============================================================================
 
+def install_fast_event_loop():
+    """Use uvloop for the event loop when it's installed (not available on Windows)"""
+    try:
+        import uvloop
+    except ImportError:
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
 async def main():
     """Example usage"""
     if len(sys.argv) < 2:
@@ -1034,7 +1596,10 @@ async def main():
     input_folder = sys.argv[1]
     output_dir = sys.argv[2] if len(sys.argv) > 2 else "./output"
     
-    result = await process_car_images(input_folder, output_dir)
+    try:
+        result = await process_car_images(input_folder, output_dir)
+    finally:
+        await close_http_session()
     
     if "error" in result:
         print(f"\nERROR: {result['error']}")
@@ -1078,4 +1643,5 @@ async def main():
     print(f"\nAll outputs saved to: {output_dir}/")
 
 if __name__ == "__main__":
+    install_fast_event_loop()
     asyncio.run(main())
\ No newline at end of file